@@ -0,0 +1,61 @@
+"""Exporta o modelo treinado (.pkl do joblib) para o arquivo .npz lido pelo st_app.py.
+
+O app usa apenas os coeficientes da regressão logística e a saída do OneHotEncoder
+para cada UF conhecida, então não precisa carregar scikit-learn/joblib em produção.
+Rode novamente sempre que o modelo .pkl for re-treinado:
+
+    python export_model.py [caminho_pkl] [caminho_npz]
+"""
+import sys
+import warnings
+
+import joblib
+import numpy as np
+from scipy.special import expit
+
+PKL_PATH = "./resultados_parciais/modelo_logistico.pkl"
+NPZ_PATH = "./resultados_parciais/modelo_logistico.npz"
+
+
+def export_model(pkl_path, npz_path):
+    """Converts the (model, encoder) pickle to .npz, checking it reproduces predict_proba."""
+    model, encoder = joblib.load(pkl_path)
+
+    coef = np.asarray(model.coef_, dtype=np.float64)
+    if coef.shape[0] != 1:
+        raise ValueError("Apenas regressão logística binária é suportada.")
+    weights = coef.ravel()
+    intercept = float(np.ravel(model.intercept_)[0])
+
+    categories = np.asarray(encoder.categories_[0], dtype=str)
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='X does not have valid feature names')
+        # Conferir que o kernel expit(X @ w + b) reproduz o sklearn
+        probe = np.vstack([np.zeros(len(weights)), np.eye(len(weights))])
+        if not np.allclose(expit(probe @ weights + intercept), model.predict_proba(probe)[:, 1]):
+            raise ValueError("expit(X @ w + b) não reproduz model.predict_proba.")
+
+        # Saída exata do encoder para cada categoria, com os nomes das colunas na mesma ordem
+        # (o app não precisa reconstruir a lógica de drop='first')
+        uf_table = encoder.transform(categories.reshape(-1, 1).astype(object))
+        uf_table = uf_table.toarray() if hasattr(uf_table, 'toarray') else uf_table
+    uf_encoded_names = np.asarray(encoder.get_feature_names_out(['UF']), dtype=str)
+
+    np.savez(
+        npz_path,
+        weights=weights,
+        intercept=np.array(intercept),
+        feature_names=np.asarray(model.feature_names_in_, dtype=str),
+        uf_categories=categories,
+        uf_table=np.asarray(uf_table, dtype=np.float64),
+        uf_encoded_names=uf_encoded_names,
+        uf_handle_unknown=np.array(str(encoder.handle_unknown)),
+    )
+
+
+if __name__ == '__main__':
+    pkl_path = sys.argv[1] if len(sys.argv) > 1 else PKL_PATH
+    npz_path = sys.argv[2] if len(sys.argv) > 2 else NPZ_PATH
+    export_model(pkl_path, npz_path)
+    print(f"Modelo exportado para {npz_path}")
@@ -1,11 +1,15 @@
 import os
 import numpy as np
-import pandas as pd
-import joblib
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import json
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# pandas, scipy e as bibliotecas do Google são importados dentro das funções que os
+# usam: a página de espera (sem 'trigger=true') não precisa deles e abre mais rápido.
 
 # --- App Configuration ---
 st.set_page_config(page_title="Calculadora de Probabilidade de Pagamento Automática")
@@ -23,7 +27,18 @@ RANGE_NAME = 'Página1!A:G' # <<-- LER COLUNAS A ATÉ G em TODAS as linhas. Ajus
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets'] # Read and write access
 
 # --- File Paths (adjust as needed for your deployment) ---
-MODEL_PATH = "./resultados_parciais/modelo_logistico.pkl" # <<-- Verifique se o caminho do modelo está correto
+# Coeficientes exportados do modelo .pkl por export_model.py (não requer scikit-learn em produção)
+MODEL_PATH = "./resultados_parciais/modelo_logistico.npz" # <<-- Verifique se o caminho do modelo está correto
+
+# --- Cálculo por fórmula na planilha ---
+# Acima deste número de linhas a probabilidade não é calculada em Python: uma única
+# ARRAYFORMULA com os coeficientes do modelo é escrita na coluna 'Probabilidade'.
+FORMULA_ROW_THRESHOLD = 5000
+
+# --- Proteção contra reprocessamento ---
+# Reexecuções da mesma sessão dentro deste intervalo (em segundos) após um processamento
+# bem-sucedido não leem, recalculam nem reescrevem a planilha de novo.
+RERUN_COOLDOWN_SECONDS = 5
 
 # --- Streamlit Secrets Key ---
 # This key must match the section name in your .streamlit/secrets.toml
@@ -40,31 +55,221 @@ COLUMN_MAPPING = {
 # Inverse mapping (used internally for header logic, mainly for error messages)
 REVERSE_MAPPING = {v: k for k, v in COLUMN_MAPPING.items()}
 
+# Model features that are numeric values read directly from the sheet
+NUMERIC_FEATURES = ['ValorQuitacao', 'Atraso', 'Quant_Pagamentos_Via_Boleto', 'Quant_Ocorrencia']
+
+# Everything the app needs from the logistic regression and its UF one-hot encoder
+ModelBundle = namedtuple('ModelBundle', [
+    'weights',            # coef_ da regressão logística, na ordem de feature_names
+    'intercept',
+    'feature_names',      # feature_names_in_ do modelo
+    'uf_categories',      # categories_[0] do encoder
+    'uf_table',           # encoder.transform(categories_[0]): uma linha por categoria
+    'uf_encoded_names',   # encoder.get_feature_names_out(['UF']): nome de cada coluna de uf_table
+    'uf_handle_unknown',  # encoder.handle_unknown
+])
+
 
 # --- Helper Functions ---
 
-@st.cache_resource
-def load_model_and_encoder(model_path):
-    """Loads the pre-trained model and encoder, caching the result."""
+def column_number_to_letter(column_number):
+    """Converts a 1-based column number to its A1-notation letters (1 -> 'A', 27 -> 'AA')."""
+    letters = ''
+    while column_number > 0:
+        remainder = (column_number - 1) % 26
+        letters = chr(ord('A') + remainder) + letters
+        column_number = (column_number - 1) // 26
+    return letters
+
+# Letras de coluna pré-calculadas de A (1) até ZZ (702); índice 0 não é usado
+COLUMN_LETTERS = [''] + [column_number_to_letter(n) for n in range(1, 703)]
+
+@st.cache_resource(show_spinner=False)
+def load_model(model_path):
+    """Loads the exported model coefficients and UF encoding, caching the result.
+
+    Errors are raised, not reported here: st.cache_resource does not cache a failed
+    load, and wait_for_model reports it on the script thread.
+    """
+    with np.load(model_path, allow_pickle=False) as data:
+        return ModelBundle(
+            weights=data['weights'].astype(np.float64),
+            intercept=float(data['intercept']),
+            feature_names=data['feature_names'].tolist(),
+            uf_categories=data['uf_categories'].tolist(),
+            uf_table=data['uf_table'].astype(np.float64),
+            uf_encoded_names=data['uf_encoded_names'].tolist(),
+            uf_handle_unknown=str(data['uf_handle_unknown']),
+        )
+
+def submit_model_load(executor, model_path):
+    """Starts load_model on the executor, keeping the Streamlit script context.
+
+    The context lets st.cache_resource run in the worker thread as it does in the
+    script thread. Load errors are re-raised by future.result() (see wait_for_model).
+    """
+    ctx = get_script_run_ctx()
+
+    def task():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return load_model(model_path)
+
+    return executor.submit(task)
+
+def wait_for_model(model_future, model_path):
+    """Returns the result of submit_model_load, stopping the app if the load failed.
+
+    Must run on the script thread: st.stop() only stops the run from there.
+    """
     try:
-        model, encoder = joblib.load(model_path)
-        st.success("Modelo e Encoder carregados com sucesso!")
-        return model, encoder
+        return model_future.result()
     except FileNotFoundError:
-        st.error(f"Erro: Arquivo do modelo ou encoder não encontrado em {model_path}")
+        st.error(f"Erro: Arquivo do modelo não encontrado em {model_path}")
+        st.info("Gere o arquivo a partir do modelo .pkl com: python export_model.py")
         st.stop() # Stop the app execution if essential files are missing
     except Exception as e:
-        st.error(f"Erro ao carregar modelo e encoder: {e}")
+        st.error(f"Erro ao carregar modelo: {e}")
         st.stop()
 
+@st.cache_resource(show_spinner=False)
+def build_uf_table(model_path):
+    """Builds the UF encoding lookup of the model at model_path, once per model file.
+
+    Returns (categories, table): categories is a pd.Index of the known UFs, row i of
+    table is the encoder output for categories[i] and the extra last row is all zeros,
+    so a get_indexer code of -1 (unknown UF) selects it.
+    """
+    import pandas as pd
+
+    model = load_model(model_path)
+    encoded = model.uf_table
+    table = np.vstack([encoded, np.zeros((1, encoded.shape[1]))])
+    return pd.Index(model.uf_categories), table
+
+@st.cache_resource(show_spinner=False)
+def build_feature_plan(model_path):
+    """Maps each feature of the model at model_path to its source column, once per model file.
+
+    Returns (numeric_dst, numeric_names, uf_dst, uf_src, plan_warnings): model columns
+    numeric_dst come from the NUMERIC_FEATURES in numeric_names, model columns uf_dst
+    come from encoder output columns uf_src, and every other feature stays 0.
+    """
+    model = load_model(model_path)
+    # Nomes das colunas de saída do encoder (get_feature_names_out), já sem a categoria descartada
+    encoded_col_by_name = {name: j for j, name in enumerate(model.uf_encoded_names)}
+
+    numeric_dst, numeric_names, uf_dst, uf_src, plan_warnings = [], [], [], [], []
+    for j, feature_name in enumerate(model.feature_names):
+        if feature_name in NUMERIC_FEATURES:
+            numeric_dst.append(j)
+            numeric_names.append(feature_name)
+        elif feature_name in encoded_col_by_name:
+            uf_dst.append(j)
+            uf_src.append(encoded_col_by_name[feature_name])
+        elif feature_name.startswith('UF_'):
+            plan_warnings.append(f"Feature '{feature_name}' do modelo não corresponde a uma categoria conhecida pelo encoder. Usando 0.")
+        else:
+            plan_warnings.append(f"Recurso '{feature_name}' do modelo não manipulado pela lógica de processamento. Usando 0.")
+    return (np.array(numeric_dst, dtype=np.intp), numeric_names,
+            np.array(uf_dst, dtype=np.intp), np.array(uf_src, dtype=np.intp), plan_warnings)
+
+@st.cache_resource(show_spinner=False)
+def build_uf_logit_table(model_path):
+    """Logit contribution of each UF known to the model at model_path, plus 0 for unknown UFs.
+
+    A one-hot row has a single non-zero, so its product with the model weights is just
+    the weight of that category: scoring UF becomes a lookup into this vector (indexed
+    by the same get_indexer codes as build_uf_table) instead of an N x F matrix product.
+    """
+    model = load_model(model_path)
+    _, uf_table = build_uf_table(model_path)
+    _, _, uf_dst, uf_src, _ = build_feature_plan(model_path)
+    return uf_table[:, uf_src] @ model.weights[uf_dst]
+
+def build_probability_formula(model_path, idx_map_original):
+    """Builds an ARRAYFORMULA that evaluates the logistic regression inside the sheet.
+
+    idx_map_original maps model features read from the sheet to their 0-based column.
+    Rows with an empty, non-numeric (TRUE/FALSE included) or unknown-UF input evaluate
+    to '' as in the Python path, and UFs match case-sensitively there too.
+    """
+    model = load_model(model_path)
+
+    def column_range(feature_name):
+        letter = column_number_to_letter(idx_map_original[feature_name] + 1)
+        return f'{letter}2:{letter}'
+
+    def numeric_range(feature_name):
+        # A planilha trata TRUE/FALSE como 1/0 nas contas; no Python são erro de conversão
+        cells = column_range(feature_name)
+        return f'IF(ISLOGICAL({cells}),NA(),{cells})'
+
+    def number(value):
+        return np.format_float_positional(np.float64(value), trim='-')
+
+    numeric_dst, numeric_names, _, _, _ = build_feature_plan(model_path)
+    ufs_categories, _ = build_uf_table(model_path)
+
+    linear_terms = [f'({number(model.intercept)})'] + [
+        f'({number(model.weights[j])})*{numeric_range(name)}' for j, name in zip(numeric_dst, numeric_names)
+    ]
+    # Contribuição de cada UF no modelo (0 para a categoria descartada por drop='first')
+    uf_weights = build_uf_logit_table(model_path)[:-1]
+    uf_lookup = '{' + ';'.join(f'"{category}",{number(weight)}' for category, weight in zip(ufs_categories, uf_weights)) + '}'
+    uf_cell = f'TRIM({column_range("UF")})'
+    # VLOOKUP ignora maiúsculas/minúsculas: EXACT exige a grafia exata da categoria, como get_indexer no Python
+    uf_term = (f'IF(EXACT(VLOOKUP({uf_cell},{uf_lookup},1,FALSE),{uf_cell}),'
+               f'VLOOKUP({uf_cell},{uf_lookup},2,FALSE),NA())')
+    if model.uf_handle_unknown != 'error':
+        uf_term = f'IFERROR({uf_term},0)' # UF desconhecida não contribui, como no encoder
+
+    any_empty = '*'.join(f'LEN({column_range(name)})' for name in idx_map_original) + '=0'
+    logit = '+'.join(linear_terms + [uf_term])
+    return f'=ARRAYFORMULA(IF({any_empty},"",IFERROR(ROUND(1/(1+EXP(-({logit}))),4),"")))'
+
+def parse_numeric_column(column):
+    """Converts a sheet column to floats (NaN where invalid).
+
+    Unformatted numeric cells are used as-is; only cells that still arrive as
+    text (e.g. numbers typed as text) go through the decimal-comma fallback.
+    Boolean cells (checkboxes, TRUE/FALSE) are invalid, not 1/0.
+    """
+    import pandas as pd
+
+    # Sem a máscara, pd.to_numeric converteria True/False em 1.0/0.0
+    numeric = pd.to_numeric(column.mask(column.map(type).eq(bool)), errors='coerce')
+    pending_text = numeric.isna() & column.notna()
+    if pending_text.any():
+        text = column[pending_text].astype(str).str.strip().str.replace(',', '.', regex=False)
+        numeric[pending_text] = pd.to_numeric(text, errors='coerce')
+    return numeric
+
+@st.cache_resource(show_spinner=False)
 def get_google_sheets_service():
-    """Authenticates and returns the Google Sheets service object."""
+    """Authenticates and returns the Google Sheets service object, built once per process."""
+    import google_auth_httplib2
+    from google.oauth2.service_account import Credentials
+    from googleapiclient.discovery import build
+    from googleapiclient.http import HttpRequest, build_http
+
     try:
         # Use credentials from Streamlit secrets
         creds = Credentials.from_service_account_info(
             st.secrets[GCP_SECRETS_KEY], scopes=SCOPES
         )
-        service = build('sheets', 'v4', credentials=creds)
+        # O serviço é compartilhado entre sessões, mas httplib2.Http não é thread-safe:
+        # cada thread usa sua própria conexão autorizada, reaproveitada entre as requisições.
+        # build_http() mantém o timeout padrão da googleapiclient (60 s) e não segue redirecionamentos 308.
+        thread_local = threading.local()
+
+        def build_request(http, *args, **kwargs):
+            if not hasattr(thread_local, 'http'):
+                thread_local.http = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+            return HttpRequest(thread_local.http, *args, **kwargs)
+
+        # Documento de descoberta embutido no pacote, sem cache em disco nem busca na rede
+        service = build('sheets', 'v4', credentials=creds, requestBuilder=build_request,
+                        cache_discovery=False, static_discovery=True)
         # st.success("Autenticação com Google Sheets bem-sucedida!") # Optional: show success message
         return service
     except KeyError:
@@ -77,34 +282,62 @@ def get_google_sheets_service():
 
 
 def process_sheet_data(sheet_id, range_name):
-    """Reads data, processes it, calculates probabilities, and returns updated data."""
+    """Reads data, processes it and calculates probabilities.
 
-    service = get_google_sheets_service()
-    model, encoder = load_model_and_encoder(MODEL_PATH)
+    Returns a tuple (probs, error_mask, column_index, formula): one probability per data
+    row (NaN where error_mask is True) and the sheet column where they belong. For sheets
+    above FORMULA_ROW_THRESHOLD rows, probs/error_mask are None and formula holds the
+    ARRAYFORMULA to write instead. Returns None on failure; probs and formula are both
+    None when the range has no data at all.
+    """
+    import pandas as pd
+    from scipy.special import expit
 
-    st.info(f"Lendo dados da planilha: {sheet_id} - {range_name}")
+    # O modelo é carregado em paralelo com a leitura da planilha (a chamada HTTP libera o GIL)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        model_future = submit_model_load(executor, MODEL_PATH)
+        service = get_google_sheets_service()
 
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=sheet_id,
-            range=range_name
-        ).execute()
-        values = result.get('values', [])
-    except Exception as e:
-        st.error(f"Erro ao ler dados da planilha: {e}")
-        return None # Indicate failure
+        st.info(f"Lendo dados da planilha: {sheet_id} - {range_name}")
+
+        try:
+            # Valores não formatados: números chegam como float/int, sem separador decimal local
+            result = service.spreadsheets().values().get(
+                spreadsheetId=sheet_id,
+                range=range_name,
+                valueRenderOption='UNFORMATTED_VALUE',
+                dateTimeRenderOption='SERIAL_NUMBER',
+                fields='values' # Resposta apenas com os valores, sem metadados do ValueRange
+            ).execute()
+            values = result.get('values', [])
+        except Exception as e:
+            st.error(f"Erro ao ler dados da planilha: {e}")
+            return None # Indicate failure
+
+        model = wait_for_model(model_future, MODEL_PATH)
+
+    # O carregamento é cacheado; a mensagem aparece apenas uma vez por sessão
+    if not st.session_state.get('model_loaded_message_shown'):
+        st.success("Modelo carregado com sucesso!")
+        st.session_state['model_loaded_message_shown'] = True
 
     if not values:
         st.warning('Nenhum dado encontrado na planilha no intervalo especificado.')
-        return [] # Retorna lista vazia se nenhum valor lido
+        return None, None, 0, None # Nenhum valor lido
 
     header_original = values[0]
     data_rows = values[1:] # Dados a partir da segunda linha
 
+    # Coluna onde a probabilidade será escrita: a já existente ou a primeira após o cabeçalho
+    if 'Probabilidade' in header_original:
+         prob_column_index = header_original.index('Probabilidade')
+    else:
+         prob_column_index = len(header_original)
+
     if not data_rows:
          st.warning('Planilha contém apenas o cabeçalho ou está vazia após o cabeçalho no intervalo especificado.')
-         # Retorna apenas o cabeçalho lido mais a nova coluna 'Probabilidade'
-         return [header_original + ['Probabilidade']]
+         # Sem linhas: apenas o cabeçalho da coluna 'Probabilidade' será escrito
+         return np.empty(0), np.empty(0, dtype=bool), prob_column_index, None
 
 
     # --- Mapear colunas da planilha para nomes de features DO MODELO ---
@@ -121,206 +354,185 @@ def process_sheet_data(sheet_id, range_name):
         'UF' # A coluna 'UF' é lida diretamente, depois codificada
     ]
 
-    # Construir o mapeamento de nomes de features do modelo (vindo da planilha) para índices no cabeçalho original
-    idx_map_original = {}
-    for model_feature_name in model_features_from_sheet:
-         sheet_col_name_to_find = model_feature_name # Assume o nome da planilha é o mesmo por padrão
-
-         # Verificar se esta feature do modelo é um VALOR no nosso COLUMN_MAPPING
-         is_mapped = False
-         for original_sheet_name, mapped_model_name in COLUMN_MAPPING.items():
-              if mapped_model_name == model_feature_name:
-                   sheet_col_name_to_find = original_sheet_name # Encontrou o nome da planilha
-                   is_mapped = True
-                   break
-
-         # Lidar com a coluna 'UF' explicitamente
-         if model_feature_name == 'UF':
-              sheet_col_name_to_find = 'UF'
-              is_mapped = True
-
-         # Tentar encontrar o índice desta coluna no cabeçalho lido
-         try:
-              idx_map_original[model_feature_name] = header_original.index(sheet_col_name_to_find)
-         except ValueError:
-              error_msg = f"Erro: Coluna esperada '{sheet_col_name_to_find}' não encontrada no cabeçalho da planilha lido."
-              if not is_mapped:
-                   error_msg = f"Erro: Coluna esperada '{model_feature_name}' não encontrada no cabeçalho da planilha lido."
-
-              st.error(error_msg)
-              st.info(f"Cabeçalho lido da planilha: {header_original}")
-              st.info(f"Procurando no cabeçalho por colunas que correspondem a estas features do modelo: {model_features_from_sheet}")
-              return None
-
-    # Prepare list for updating (includes header with new column)
-    updated_header = header_original[:]
-    if 'Probabilidade' not in updated_header:
-         updated_header.append('Probabilidade')
-
-    updated_values = [updated_header]
-
+    # Construir o mapeamento de nomes de features do modelo (vindo da planilha) para índices no cabeçalho original.
+    # O resultado fica na sessão: reexecuções com o mesmo cabeçalho reaproveitam o mapeamento.
+    cached_header_map = st.session_state.get('header_idx_map')
+    if cached_header_map is not None and cached_header_map[0] == tuple(header_original):
+        idx_map_original = cached_header_map[1]
+    else:
+        idx_map_original = {}
+        for model_feature_name in model_features_from_sheet:
+             sheet_col_name_to_find = model_feature_name # Assume o nome da planilha é o mesmo por padrão
+
+             # Verificar se esta feature do modelo é um VALOR no nosso COLUMN_MAPPING
+             is_mapped = False
+             for original_sheet_name, mapped_model_name in COLUMN_MAPPING.items():
+                  if mapped_model_name == model_feature_name:
+                       sheet_col_name_to_find = original_sheet_name # Encontrou o nome da planilha
+                       is_mapped = True
+                       break
+
+             # Lidar com a coluna 'UF' explicitamente
+             if model_feature_name == 'UF':
+                  sheet_col_name_to_find = 'UF'
+                  is_mapped = True
+
+             # Tentar encontrar o índice desta coluna no cabeçalho lido
+             try:
+                  idx_map_original[model_feature_name] = header_original.index(sheet_col_name_to_find)
+             except ValueError:
+                  error_msg = f"Erro: Coluna esperada '{sheet_col_name_to_find}' não encontrada no cabeçalho da planilha lido."
+                  if not is_mapped:
+                       error_msg = f"Erro: Coluna esperada '{model_feature_name}' não encontrada no cabeçalho da planilha lido."
+
+                  st.error(error_msg)
+                  st.info(f"Cabeçalho lido da planilha: {header_original}")
+                  st.info(f"Procurando no cabeçalho por colunas que correspondem a estas features do modelo: {model_features_from_sheet}")
+                  return None
+
+        st.session_state['header_idx_map'] = (tuple(header_original), idx_map_original)
+
+    if len(data_rows) > FORMULA_ROW_THRESHOLD:
+        st.info(f"{len(data_rows)} linhas: a probabilidade será calculada por fórmula na própria planilha.")
+        return None, None, prob_column_index, build_probability_formula(MODEL_PATH, idx_map_original)
 
     st.info(f"Processando {len(data_rows)} linhas...")
     progress_bar = st.progress(0)
 
-    processed_rows_count = 0
-    errored_rows_count = 0
-
-    # Process each row to calculate probability
-    for i, row in enumerate(data_rows):
-        row_processed = row[:]
-        while len(row_processed) < len(header_original):
-            row_processed.append('')
-
-        prob_value = ''
-        row_error = False
-
-        # --- Ler e Validar Dados da Linha ---
-        input_data_for_encoding = {}
+    # --- Validação e conversão em lote ---
+    # Todas as linhas são lidas para um único DataFrame (por posição, pois as linhas
+    # vindas da API podem ter tamanhos diferentes) e convertidas de uma só vez.
+    # Apenas as colunas usadas pelo modelo são extraídas, sem copiar a planilha inteira;
+    # colunas além da última célula preenchida de todas as linhas ficam vazias (None).
+    df = pd.DataFrame(data_rows)
+    empty_column = pd.Series([None] * len(df), dtype=object)
+    sheet_columns = {
+        model_feature_name: df[original_idx] if original_idx < df.shape[1] else empty_column
+        for model_feature_name, original_idx in idx_map_original.items()
+    }
+
+    # Dado essencial vazio em qualquer coluna
+    missing_mask = np.zeros(len(df), dtype=bool)
+    for column in sheet_columns.values():
+        missing_mask |= (column.isna() | column.astype(str).str.strip().eq('')).to_numpy()
+
+    numeric_df = pd.DataFrame({name: parse_numeric_column(sheet_columns[name]) for name in NUMERIC_FEATURES})
+    conversion_error_mask = ~missing_mask & ~np.isfinite(numeric_df.to_numpy()).all(axis=1)
+
+    uf_series = sheet_columns['UF'].fillna('').astype(str).str.strip()
+    ufs_categories, _ = build_uf_table(MODEL_PATH)
+    # Código da UF na tabela de codificação (-1 = desconhecida), calculado uma única vez
+    uf_codes = ufs_categories.get_indexer(uf_series)
+    if model.uf_handle_unknown == 'error':
+        unknown_uf_mask = ~missing_mask & ~conversion_error_mask & (uf_codes < 0)
+    else:
+        unknown_uf_mask = np.zeros(len(df), dtype=bool)
+
+    valid_mask = ~(missing_mask | conversion_error_mask | unknown_uf_mask)
+    # O progresso avança por etapa do lote (validação, montagem, predição), nunca por linha
+    progress_bar.progress(1 / 3)
+
+    # Erros por linha são acumulados e exibidos num único resumo ao final
+    sheet_row_numbers = np.arange(2, len(df) + 2)
+    row_errors = pd.concat([
+        pd.DataFrame({'linha': sheet_row_numbers[missing_mask], 'erro': 'Dado essencial vazio.'}),
+        pd.DataFrame({'linha': sheet_row_numbers[conversion_error_mask],
+                      'erro': 'Erro de conversão de tipo. Verifique os valores numéricos.'}),
+        pd.DataFrame({'linha': sheet_row_numbers[unknown_uf_mask],
+                      'erro': ("UF '" + uf_series[unknown_uf_mask] + "' não vista durante o treinamento do encoder.").to_numpy()}),
+    ]).sort_values('linha', kind='stable')
+
+    # --- Calcular todas as probabilidades ---
+    prob_values = np.full(len(data_rows), np.nan)
+    if valid_mask.any():
         try:
-            for model_feature_name in model_features_from_sheet:
-                 original_idx = idx_map_original[model_feature_name]
-                 value = str(row_processed[original_idx]).strip()
-
-                 if not value:
-                      row_error = True
-                      break # Dado essencial vazio
-
-                 input_data_for_encoding[model_feature_name] = value
-
-            if not row_error: # Somente se todos os essenciais estiverem presentes
-                try:
-                     # Converter numéricos, lidar com vírgula decimal
-                     valor_quitacao = float(input_data_for_encoding['ValorQuitacao'].replace(',', '.'))
-                     atraso = float(input_data_for_encoding['Atraso'].replace(',', '.'))
-                     quant_boletos = float(input_data_for_encoding['Quant_Pagamentos_Via_Boleto'].replace(',', '.'))
-                     quant_ocorrencia = float(input_data_for_encoding['Quant_Ocorrencia'].replace(',', '.'))
-                     uf = input_data_for_encoding['UF']
-
-                except ValueError as ve:
-                     st.warning(f"Erro de conversão de tipo na linha {i+2}: {ve}. Verifique os valores numéricos.")
-                     row_error = True
-
-            # Codificar UF
-            if not row_error:
-                 uf_for_encoding = np.array([[uf]])
-                 try:
-                     uf_encoded = encoder.transform(uf_for_encoding) # Sem .toarray()
-                     if hasattr(encoder, 'handle_unknown') and encoder.handle_unknown == 'error':
-                          ufs_categories = encoder.categories_[0].tolist()
-                          if uf not in ufs_categories:
-                               raise ValueError(f"UF '{uf}' não vista durante o treinamento do encoder.")
-                 except Exception as e:
-                     st.warning(f"Erro durante a codificação da UF '{uf}' na linha {i+2}: {e}")
-                     row_error = True
-
-            # --- Montar Vetor FINAL para o Modelo ---
-            if not row_error:
-                input_vector_list = []
-                processed_numerical_values = {
-                    'ValorQuitacao': valor_quitacao,
-                    'Atraso': atraso,
-                    'Quant_Pagamentos_Via_Boleto': quant_boletos,
-                    'Quant_Ocorrencia': quant_ocorrencia,
-                }
-                ufs_categories = encoder.categories_[0].tolist()
-
-                for feature_name in model.feature_names_in_:
-                     if feature_name in processed_numerical_values:
-                          input_vector_list.append(processed_numerical_values[feature_name])
-                     elif feature_name.startswith('UF_'):
-                         try:
-                              uf_category = feature_name[3:]
-                              if hasattr(encoder, 'drop') and encoder.drop == 'first' and len(ufs_categories) > 0:
-                                  categories_after_drop = ufs_categories[1:]
-                                  if uf_category in categories_after_drop:
-                                       category_index_in_encoded_output = categories_after_drop.index(uf_category)
-                                       input_vector_list.append(uf_encoded[0, category_index_in_encoded_output])
-                                  else:
-                                       input_vector_list.append(0.0)
-                              else: # Sem drop='first'
-                                  if uf_category in ufs_categories:
-                                      category_index_in_original_categories = ufs_categories.index(uf_category)
-                                      input_vector_list.append(uf_encoded[0, category_index_in_original_categories])
-                                  else:
-                                      st.warning(f"Feature '{feature_name}' do modelo não corresponde a uma categoria conhecida pelo encoder. Usando 0.")
-                                      input_vector_list.append(0.0)
-                         except Exception as e:
-                              st.warning(f"Erro ao mapear feature '{feature_name}' para valor encoded na linha {i+2}: {e}. Usando 0.")
-                              input_vector_list.append(0.0)
-                     else:
-                          st.warning(f"Recurso '{feature_name}' do modelo não manipulado pela lógica de processamento. Usando 0.")
-                          input_vector_list.append(0.0)
-
-                input_vector = np.array([input_vector_list])
-                input_df = pd.DataFrame(input_vector, columns=model.feature_names_in_)
-
-                prob = model.predict_proba(input_df)[:, 1][0]
-                prob_value = f"{prob:.4f}".replace('.', ',')
-
+            numeric_dst, numeric_names, _, _, plan_warnings = build_feature_plan(MODEL_PATH)
+            for plan_warning in plan_warnings:
+                st.warning(plan_warning)
+
+            # Regressão logística binária: P(classe 1) = expit(X @ w + b). A parte one-hot de X
+            # não é montada: a contribuição da UF vem direto da tabela (código -1 -> 0).
+            numeric_values = numeric_df[numeric_names].to_numpy()[valid_mask]
+            uf_logits = build_uf_logit_table(MODEL_PATH)[uf_codes[valid_mask]]
+            progress_bar.progress(2 / 3)
+
+            probs = expit(numeric_values @ model.weights[numeric_dst] + uf_logits + model.intercept)
+            prob_values[valid_mask] = np.round(probs, 4)
+            progress_bar.progress(1.0)
         except Exception as e:
-            st.error(f"Erro inesperado no processamento da linha {i+2}: {e}")
-            row_error = True
-
-        if row_error:
-            prob_value = ''
-            errored_rows_count += 1
-
-        updated_values.append(row_processed + [prob_value])
-        processed_rows_count += 1
-
-        if len(data_rows) > 0:
-             progress_bar.progress((i + 1) / len(data_rows))
+            st.error(f"Erro inesperado no cálculo das probabilidades: {e}")
+            return None
 
+    processed_rows_count = len(data_rows)
+    errored_rows_count = int((~valid_mask).sum())
 
     progress_bar.empty()
 
     if errored_rows_count > 0:
         st.warning(f"Processamento concluído. {processed_rows_count} linhas processadas, com {errored_rows_count} erros.")
+        with st.expander(f"{len(row_errors)} linhas com erro"):
+            st.dataframe(row_errors, hide_index=True)
     else:
         st.success(f"Processamento concluído. {processed_rows_count} linhas processadas com sucesso.")
 
-    return updated_values
+    return prob_values, ~valid_mask, prob_column_index, None
 
 
-def update_sheet(sheet_id, updated_data):
-    """Updates the Google Sheet with the processed data."""
-    if not updated_data or (len(updated_data) == 1 and len(updated_data[0]) < 2):
+def update_sheet(sheet_id, probs, error_mask, column_index, formula=None):
+    """Writes the 'Probabilidade' column (header + one cell per row) to the Google Sheet.
+
+    Returns True if the sheet was updated.
+
+    When a formula is given, only the header and the ARRAYFORMULA are written (in row 2)
+    and the rest of the column is cleared so the formula can expand.
+    """
+    if probs is None and formula is None:
          st.warning("Nenhum dado ou cabeçalho completo para atualizar.")
-         return
+         return False
 
     service = get_google_sheets_service()
 
-    # Calcular o Range de Atualização com base nos updated_data e no nome da aba
-    num_rows_to_update = len(updated_data)
-    num_cols_to_update = len(updated_data[0])
-
-    update_last_col_letter = ''
-    temp_index = num_cols_to_update
-    if temp_index == 0:
-         update_last_col_letter = 'A'
+    # Calcular o Range de Atualização com base no número de linhas e no nome da aba
+    if formula is not None:
+         num_rows_to_update = 2 # Cabeçalho + fórmula
+         column_values = [['Probabilidade'], [formula]]
     else:
-        while temp_index > 0:
-            remainder = (temp_index - 1) % 26
-            update_last_col_letter = chr(ord('A') + remainder) + update_last_col_letter
-            temp_index = (temp_index - 1) // 26
+         num_rows_to_update = len(probs) + 1 # Cabeçalho + linhas de dados
+         # Números crus: com USER_ENTERED a planilha os exibe no seu próprio formato/locale
+         column_values = [['Probabilidade']] + [[''] if errored else [prob]
+                                                for prob, errored in zip(probs.tolist(), error_mask.tolist())]
+    num_cols_to_update = column_index + 1
+
+    if num_cols_to_update < len(COLUMN_LETTERS):
+         update_last_col_letter = COLUMN_LETTERS[num_cols_to_update]
+    else:
+         update_last_col_letter = column_number_to_letter(num_cols_to_update)
 
     sheet_name_from_range = RANGE_NAME.split('!')[0] if '!' in RANGE_NAME else 'Página1'
-    update_range_string = f'{sheet_name_from_range}!A1:{update_last_col_letter}{num_rows_to_update}'
+    update_range_string = f'{sheet_name_from_range}!{update_last_col_letter}1:{update_last_col_letter}{num_rows_to_update}'
 
 
     st.info(f"Atualizando planilha: {sheet_id} - {update_range_string}")
 
     try:
+        if formula is not None:
+            # A ARRAYFORMULA só se expande sobre células vazias
+            service.spreadsheets().values().clear(
+                spreadsheetId=sheet_id,
+                range=f'{sheet_name_from_range}!{update_last_col_letter}3:{update_last_col_letter}',
+                body={}
+            ).execute()
         service.spreadsheets().values().update(
             spreadsheetId=sheet_id,
             range=update_range_string,
-            valueInputOption='RAW',
-            body={'values': updated_data}
+            valueInputOption='USER_ENTERED',
+            body={'values': column_values}
         ).execute()
         st.success('Planilha atualizada com sucesso!')
+        return True
     except Exception as e:
         st.error(f"Erro ao atualizar planilha: {e}")
+        return False
 
 
 # --- Streamlit App Layout ---
@@ -341,19 +553,25 @@ if 'trigger' in query_params and query_params['trigger'] == 'true':
     st.header("Processamento Automático Iniciado")
     st.write("Acionado pela planilha Google Sheets.")
 
-    # Adiciona um spinner durante o processamento
-    with st.spinner("Processando dados da planilha..."):
-        st.markdown("---")
-        st.header("Status do Processamento")
-
-        # Executa as funções de processamento e atualização usando as constantes fixas
-        updated_data = process_sheet_data(SPREADSHEET_ID, RANGE_NAME)
-
-        # Só atualiza se o processamento não falhou criticamente (retornou None)
-        if updated_data is not None:
-             update_sheet(SPREADSHEET_ID, updated_data)
-        else:
-             st.error("Processamento falhou devido a um erro na leitura ou validação inicial dos dados.")
+    # Evita reprocessar a planilha em reexecuções logo após um processamento concluído
+    if time.time() - st.session_state.get('last_run_ts', 0) < RERUN_COOLDOWN_SECONDS:
+        st.warning("A planilha acabou de ser processada nesta sessão. Aguarde alguns segundos antes de acionar novamente.")
+    else:
+        # Adiciona um spinner durante o processamento
+        with st.spinner("Processando dados da planilha..."):
+            st.markdown("---")
+            st.header("Status do Processamento")
+
+            # Executa as funções de processamento e atualização usando as constantes fixas
+            result = process_sheet_data(SPREADSHEET_ID, RANGE_NAME)
+
+            # Só atualiza se o processamento não falhou criticamente (retornou None)
+            if result is not None:
+                 probs, error_mask, prob_column_index, formula = result
+                 if update_sheet(SPREADSHEET_ID, probs, error_mask, prob_column_index, formula):
+                      st.session_state['last_run_ts'] = time.time()
+            else:
+                 st.error("Processamento falhou devido a um erro na leitura ou validação inicial dos dados.")
 
     # Opcional: Adicionar uma mensagem final após a conclusão do processamento
     # st.write("Processamento concluído.")